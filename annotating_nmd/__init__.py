@@ -3,8 +3,23 @@
 
 import numpy as np
 import pandas as pd
+import re
 import warnings
 
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+except ImportError:
+    pa = None
+    pc = None
+
+# RefSeq CDS ID as downloaded from UCSC Genome Browser, e.g. NM_138576.4_cds_0_0_chr14_99640488_r
+_CDSID_RE = re.compile(r'(?P<transcript_name>^.*\.\d*)_cds.*$')
+# HGVSp truncating frameshift, e.g. NP_003611.1:p.Cys300LeufsTer129
+_HGVSP_RE = re.compile(r'^.*\.\d*:p\..{3}(?P<var_pdot>\d*).{3}fsTer(?P<stop_pdot_shift>\d*)')
+
+_BED_COLUMNS = ['chrom', 'start', 'end', 'cds_id', 'score', 'strand']
+
 
 class ParentWarnings(Warning):
     def __init__(self, message):
@@ -22,6 +37,43 @@ class HGVSpPatternWarning(ParentWarnings):
     pass
 
 
+def extract_groups(values, pattern):
+    """
+    Helper function to extract regex capture groups from a series of strings. If pyarrow is installed and every group in
+    the pattern is named, the vectorized pyarrow (RE2) kernel is used, otherwise falls back to pandas str.extract. The
+    fallback is also used for patterns RE2 does not support (e.g. lookarounds) and for non-ASCII strings, where RE2
+    and python re disagree on what counts as a digit or word character.
+
+    :param values: pandas series of strings, non-string values are treated as non-matches
+    :param pattern: regex string or compiled regex with capture groups
+    :return: pandas dataframe with 1 column per capture group, NaN where the pattern does not match
+    """
+    pattern = re.compile(pattern)
+
+    if pc is None or len(pattern.groupindex) != pattern.groups or pattern.flags & ~re.UNICODE:
+        return values.str.extract(pattern)
+
+    try:
+        arrow_values = pa.array(values, type=pa.string(), from_pandas=True)
+    except (pa.ArrowTypeError, pa.ArrowInvalid):
+        # non-string values (e.g. integers in an object column) are handled as non-matches by str.extract
+        return values.str.extract(pattern)
+
+    # RE2 character classes are ASCII only, python re matches unicode digits, word characters etc.
+    if not pc.all(pc.string_is_ascii(arrow_values)).as_py():
+        return values.str.extract(pattern)
+
+    try:
+        extracted = pc.extract_regex(arrow_values, pattern.pattern)
+    except pa.ArrowInvalid:
+        # pattern uses syntax RE2 does not support (e.g. lookarounds or backreferences)
+        return values.str.extract(pattern)
+
+    return pd.DataFrame(
+        {name: pc.struct_field(extracted, name).to_pandas() for name in pattern.groupindex}
+    ).set_axis(values.index)
+
+
 def check_bed(bed_df):
     """
     Checks whether dataframe is in 6-column bed format with expected headers. If the dataframe has fewer than 6 columns
@@ -32,7 +84,7 @@ def check_bed(bed_df):
     :param bed_df: pandas dataframe
     :return: same dataframe or with renamed columns
     """
-    col_names = ['chrom', 'start', 'end', 'cds_id', 'score', 'strand']
+    col_names = _BED_COLUMNS
 
     if (len(bed_df.columns) < 6) or (len(bed_df.columns) > 6 and not all([col in bed_df.columns for col in col_names])):
         raise Exception("BED file is not in 6 column format")
@@ -47,38 +99,77 @@ def check_bed(bed_df):
     return bed_df
 
 
-def sort_transcript_bed(transcript_df):
+def sort_transcript_bed(transcript_df, n_exons=None):
     """
     Helper function to check and sort transcript_df. Sorting by transcript strand is necessary for determining first
     vs. last coding exons.
 
     :param transcript_df: pandas dataframe with 1 transcript's coding exons in 6-column bed format
+    :param n_exons: if provided, only the last n_exons coding exons in the transcript are selected (partial sort)
     :return: same dataframe sorted by gene orientation and by start coordinate
     """
-    transcript_df = check_bed(transcript_df).copy()
-
+    # preprocess_bed runs check_bed itself
     if 'cds_size' not in transcript_df.columns:
         transcript_df = preprocess_bed(transcript_df)
+    else:
+        transcript_df = check_bed(transcript_df)
 
+    # + strand sorts by descending start, - strand by ascending start
+    starts = transcript_df.start.to_numpy()
     if transcript_df.strand.values[0] == '+':
-        ascending_sort = False
+        sort_key = -starts
+    else:
+        sort_key = starts
+
+    if n_exons is not None and n_exons < len(sort_key):
+        sorted_idx = np.argpartition(sort_key, n_exons - 1)[:n_exons]
+        sorted_idx = sorted_idx[np.argsort(sort_key[sorted_idx], kind='stable')]
     else:
-        ascending_sort = True
+        sorted_idx = np.argsort(sort_key, kind='stable')
 
-    transcript_df.sort_values('start', ascending=ascending_sort, inplace=True)
-    transcript_df.reset_index(inplace=True)
+    # iloc returns a new dataframe, so the caller's dataframe is left untouched
+    transcript_df = transcript_df.iloc[sorted_idx].reset_index()
 
     return transcript_df
 
 
-def preprocess_bed(bed_df, capture_pattern='(^.*\.\d*)_cds.*$'):
+def rank_bed(bed_df):
+    """
+    Helper function to sort ALL transcripts in a bed dataframe by gene orientation and by start coordinate in one pass,
+    and rank each coding exon from the end of its transcript (0 = last CDS exon, 1 = penultimate CDS exon, ...)
+
+    :param bed_df: pandas dataframe with 6-columns bed format and additional "transcript_name" and "cds_size" columns
+        assuming preprocess_bed has been run
+    :return: sorted copy of bed_df with an additional "cds_rank" column, exons without a transcript_name are dropped
+    """
+    # + strand transcripts sort by descending start, - strand transcripts by ascending start
+    starts = bed_df.start.to_numpy()
+    sort_key = np.where((bed_df.strand == '+').to_numpy(), -starts, starts)
+
+    # integer transcript codes in name order, missing transcript names are coded -1
+    transcript_codes, transcript_names = pd.factorize(bed_df.transcript_name, sort=True)
+    n_missing = np.count_nonzero(transcript_codes == -1)
+
+    # sort once (dropping exons without a transcript name, like groupby), then rank = position within each contiguous
+    # run of transcript codes
+    sorted_idx = np.lexsort((sort_key, transcript_codes))[n_missing:]
+    group_counts = np.bincount(transcript_codes[sorted_idx], minlength=len(transcript_names))
+    group_starts = np.cumsum(group_counts) - group_counts
+
+    ranked_df = bed_df.iloc[sorted_idx].copy()
+    ranked_df['cds_rank'] = np.arange(len(sorted_idx)) - np.repeat(group_starts, group_counts)
+
+    return ranked_df
+
+
+def preprocess_bed(bed_df, capture_pattern=_CDSID_RE):
     """
     Pre-process CDS bed dataframe to 1) extract transcript_name from CDS ID, and, 2) determine regions sizes.
     CDS ID defaults to be the format downloaded from UCSC Genome Browser for CDS bed for RefSeq transcripts
 
     :param bed_df: pandas dataframe with 6-columns bed format and the following named columns:
         ['chrom', 'start', 'end', 'cds_id', 'score', 'strand']
-    :return: processed bed_df
+    :return: processed bed_df, with a categorical strand column
     """
 
     bed_df = check_bed(bed_df)
@@ -86,9 +177,12 @@ def preprocess_bed(bed_df, capture_pattern='(^.*\.\d*)_cds.*$'):
     # drop dups due to PAR
     bed_df = bed_df.drop_duplicates(['cds_id', 'start'])
 
-    bed_df['transcript_name'] = bed_df.cds_id.str.extract(capture_pattern)
+    bed_df['transcript_name'] = extract_groups(bed_df.cds_id, capture_pattern).iloc[:, 0]
     bed_df['cds_size'] = bed_df.end - bed_df.start
 
+    # strand comparisons run on integer category codes, categories are the observed strands (e.g. '+', '-', '.')
+    bed_df['strand'] = bed_df.strand.astype('category')
+
     return bed_df
 
 
@@ -103,22 +197,40 @@ def get_nmd_escape_size(transcript_df):
     :return: total size of NMD(-) region per transcript following 55 nt rule
     """
 
-    transcript_df = sort_transcript_bed(transcript_df).copy()
+    transcript_df = sort_transcript_bed(transcript_df, n_exons=2)
 
-    nmd_size = 0
-    for i, row in transcript_df.iterrows():
-        if i == 0:
-            # if first exon in df (meaning last exon in transcript), grab entire CDS of exon
-            nmd_size += row.cds_size
-        elif i == 1:
-            # if second exon in df (meaning penultimate exon in transcript), grab the minimum of 55nt or exon size
-            nmd_size += min([row.cds_size, 55])
-        else:
-            return nmd_size
+    sizes = transcript_df['cds_size'].to_numpy()
+
+    # first exon in df (meaning last exon in transcript), grab entire CDS of exon
+    nmd_size = int(sizes[0])
+    if len(sizes) > 1:
+        # second exon in df (meaning penultimate exon in transcript), grab the minimum of 55nt or exon size
+        nmd_size += min(int(sizes[1]), 55)
 
     return nmd_size
 
 
+def get_nmd_escape_sizes(cds_sizes, group_counts):
+    """
+    Determine NMD(-) size for many transcripts at once (see get_nmd_escape_size), from flat arrays of CDS sizes laid out
+    as contiguous runs per transcript
+
+    :param cds_sizes: numpy array of CDS sizes, sorted as in rank_bed so each transcript starts with its last CDS exon
+    :param group_counts: numpy array with the number of CDS exons per transcript, in the same order as cds_sizes
+    :return: numpy array with total size of NMD(-) region per transcript following 55 nt rule
+    """
+    group_starts = np.cumsum(group_counts) - group_counts
+
+    # last exon in transcript, grab entire CDS of exon
+    nmd_sizes = cds_sizes[group_starts]
+
+    # penultimate exon in transcript (if any), grab the minimum of 55nt or exon size
+    has_penultimate = group_counts > 1
+    nmd_sizes[has_penultimate] += np.minimum(cds_sizes[group_starts[has_penultimate] + 1], 55)
+
+    return nmd_sizes
+
+
 def get_nmd_escape_boundaries(transcript_df):
     """
     Create a bed dataframe of NMD(-) regions.
@@ -130,39 +242,69 @@ def get_nmd_escape_boundaries(transcript_df):
     :return: nmd_bed dataframe
     """
 
-    transcript_df = sort_transcript_bed(transcript_df)
-
-    nmd_bed = pd.DataFrame()
-    for i, row in transcript_df.iterrows():
-        if i == 0:
-            nmd_bed = pd.concat([nmd_bed, pd.DataFrame(row).transpose()], ignore_index = True)
-        elif i == 1:
-            remaining_nmd_size = min([55, row.cds_size]) # if cds is bigger than needed, then adjust start/stop to be size 55
-            if row.strand == '+':
-                row['start'] = row.end - remaining_nmd_size
-            else:
-                row['end'] = row.start + remaining_nmd_size
-            row['cds_size'] = row.end - row.start
-            nmd_bed = pd.concat([nmd_bed, pd.DataFrame(row).transpose()], ignore_index = True)
+    # last 2 CDS exons in transcript
+    nmd_bed = sort_transcript_bed(transcript_df, n_exons=2)
+
+    if len(nmd_bed) == 2:
+        starts = nmd_bed.start.to_numpy(copy=True)
+        ends = nmd_bed.end.to_numpy(copy=True)
+        sizes = nmd_bed.cds_size.to_numpy(copy=True)
+
+        remaining_nmd_size = min(55, sizes[1]) # if cds is bigger than needed, then adjust start/stop to be size 55
+        if nmd_bed.strand.to_numpy()[1] == '+':
+            starts[1] = ends[1] - remaining_nmd_size
         else:
-            return nmd_bed
+            ends[1] = starts[1] + remaining_nmd_size
+        sizes[1] = ends[1] - starts[1]
+
+        nmd_bed['start'] = starts
+        nmd_bed['end'] = ends
+        nmd_bed['cds_size'] = sizes
 
     return nmd_bed
 
 
 def make_boundaries_df(bed_df):
     """
-    Convenience wrapper to apply get_nmd_escape_boundaries to ALL transcripts in a pandas dataframe
+    Convenience wrapper to determine NMD(-) boundaries (see get_nmd_escape_boundaries) for ALL transcripts in a pandas
+    dataframe at once
 
     :param bed_df: pandas dataframe with 6-columns bed format and the following named columns:
         ['chrom', 'start', 'end', 'cds_id', 'score', 'strand']
-    :return: boundaries_df, pandas dataframe in bed format with NMD(-) boundaries
+    :return: boundaries_df, pandas dataframe in bed format with NMD(-) boundaries, same as applying
+        get_nmd_escape_boundaries per transcript_name group
     """
-    if 'transcript_name' not in bed_df.columns:
+    # preprocess_bed runs check_bed itself
+    if 'cds_size' not in bed_df.columns:
         bed_df = preprocess_bed(bed_df)
+    else:
+        bed_df = check_bed(bed_df)
+
+    # keep the last 2 CDS exons per transcript
+    boundaries_df = rank_bed(bed_df)
+    boundaries_df = boundaries_df[boundaries_df.cds_rank < 2].copy()
+
+    # if penultimate cds is bigger than needed, then adjust start/stop to be size 55. The strand branch is resolved once
+    # into + and - strand row positions, so each clip below only touches the penultimate exons it applies to
+    penultimate = boundaries_df.cds_rank.to_numpy() == 1
+    is_plus = (boundaries_df.strand == '+').to_numpy()
+    plus_idx = np.flatnonzero(penultimate & is_plus)
+    minus_idx = np.flatnonzero(penultimate & ~is_plus)
 
-    boundaries_df = bed_df.groupby('transcript_name').apply(get_nmd_escape_boundaries, include_groups=False)
-    return boundaries_df
+    starts = boundaries_df.start.to_numpy(copy=True)
+    ends = boundaries_df.end.to_numpy(copy=True)
+    sizes = boundaries_df.cds_size.to_numpy()
+    starts[plus_idx] = ends[plus_idx] - np.minimum(55, sizes[plus_idx])
+    ends[minus_idx] = starts[minus_idx] + np.minimum(55, sizes[minus_idx])
+
+    boundaries_df['start'] = starts
+    boundaries_df['end'] = ends
+    boundaries_df['cds_size'] = ends - starts
+
+    # same layout as the per transcript groupby: original row label in "index", position within transcript in index
+    boundaries_df = boundaries_df.reset_index().set_index(['transcript_name', 'cds_rank'])
+
+    return boundaries_df.rename_axis(['transcript_name', None])
 
 
 def make_cds_size_df(bed_df):
@@ -175,26 +317,100 @@ def make_cds_size_df(bed_df):
     :return: sizes: pandas dataframe with per transcript CDS, NMD(-), and pdot lengths
     """
 
-    bed_df = check_bed(bed_df)
-
+    # preprocess_bed runs check_bed itself
     if 'cds_size' not in bed_df.columns:
         bed_df = preprocess_bed(bed_df)
+    else:
+        bed_df = check_bed(bed_df)
+
+    ranked_df = rank_bed(bed_df)
+    cds_sizes = ranked_df.cds_size.to_numpy()
+    group_starts, group_counts = get_transcript_runs(ranked_df)
+
+    # cds size and nmd(-) size per transcript from the same pass over the ranked exons
+    sizes = pd.DataFrame({
+        'transcript_name': ranked_df.transcript_name.to_numpy()[group_starts],
+        'cds_size': np.add.reduceat(cds_sizes, group_starts),
+        'nmd_escape_size': get_nmd_escape_sizes(cds_sizes, group_counts)
+    })
 
-    cds_sizes = bed_df.groupby('transcript_name').cds_size.sum().reset_index().rename(columns={0: 'cds_size'})
-    nmd_sizes = bed_df.groupby('transcript_name').apply(
-        get_nmd_escape_size, include_groups=False
-    ).reset_index().rename(columns={0: 'nmd_escape_size'})
+    return add_pdot_columns(sizes)
 
-    # combine cds size and nmd(-) size into 1 dataframe
-    sizes = cds_sizes.merge(nmd_sizes, on='transcript_name', how='outer')
 
-    # calculate pdot for NMD(-)
+def get_transcript_runs(ranked_df):
+    """
+    Helper function to locate each transcript in a rank_bed sorted dataframe. Each transcript is a contiguous run of
+    ranked exons starting at its last CDS exon (cds_rank 0)
+
+    :param ranked_df: pandas dataframe returned by rank_bed
+    :return: numpy arrays of the start position and number of CDS exons of each transcript
+    """
+    group_starts = np.flatnonzero(ranked_df.cds_rank.to_numpy() == 0)
+    group_counts = np.diff(np.append(group_starts, len(ranked_df)))
+
+    return group_starts, group_counts
+
+
+def add_pdot_columns(sizes):
+    """
+    Helper function to calculate total pdot length and pdot start position for the NMD(-) region
+
+    :param sizes: pandas dataframe with per transcript "cds_size" and "nmd_escape_size" columns
+    :return: same dataframe with additional "total_pdot_length" and "nmd_pdot_start" columns
+    """
     sizes['total_pdot_length'] = (sizes.cds_size / 3).astype(int)
     sizes['nmd_pdot_start'] = sizes.total_pdot_length - (sizes.nmd_escape_size / 3)
 
     return sizes
 
 
+def make_cds_size_df_from_path(bed_path, chunksize=2 ** 16):
+    """
+    Memory efficient version of make_cds_size_df for large CDS bed files. The bed file is read in chunks, and only
+    partial CDS sizes and the last 2 CDS exons per transcript are kept from each chunk, so the whole bed file is never
+    loaded at once. Transcripts and duplicate CDS (see preprocess_bed) may span chunks.
+
+    :param bed_path: path to a headerless 6-column CDS bed file
+    :param chunksize: number of bed lines to read at a time
+    :return: sizes: pandas dataframe with per transcript CDS, NMD(-), and pdot lengths, same as make_cds_size_df
+    """
+    partial_cds_sizes = []
+    last_exons = []
+    seen_cds_hashes = np.array([], dtype=np.uint64)
+    for chunk in pd.read_table(bed_path, names=_BED_COLUMNS, chunksize=chunksize):
+        bed_df = preprocess_bed(chunk)
+
+        # preprocess_bed only drops dups within the chunk, also drop (cds_id, start) already seen in earlier chunks.
+        # keys are kept as sorted 64-bit hashes (8 bytes per CDS) rather than the strings themselves
+        cds_hashes = pd.util.hash_pandas_object(bed_df[['cds_id', 'start']], index=False).to_numpy()
+        is_new = ~np.isin(cds_hashes, seen_cds_hashes, assume_unique=True)
+        # only the chunk's hashes need a full sort, the stable sort then merges the 2 sorted runs in linear time
+        new_cds_hashes = np.sort(cds_hashes[is_new])
+        seen_cds_hashes = np.sort(np.concatenate([seen_cds_hashes, new_cds_hashes]), kind='stable')
+
+        ranked_df = rank_bed(bed_df[is_new])
+        group_starts, _ = get_transcript_runs(ranked_df)
+        partial_cds_sizes.append(pd.Series(
+            np.add.reduceat(ranked_df.cds_size.to_numpy(), group_starts),
+            index=ranked_df.transcript_name.to_numpy()[group_starts]
+        ))
+        last_exons.append(ranked_df[ranked_df.cds_rank < 2].drop(columns='cds_rank'))
+
+    cds_sizes = pd.concat(partial_cds_sizes).groupby(level=0).sum()
+
+    # NMD(-) size only depends on the last 2 CDS exons, which are among the last 2 CDS exons of some chunk
+    ranked_df = rank_bed(pd.concat(last_exons))
+    group_starts, group_counts = get_transcript_runs(ranked_df)
+    transcript_names = ranked_df.transcript_name.to_numpy()[group_starts]
+    sizes = pd.DataFrame({
+        'transcript_name': transcript_names,
+        'cds_size': cds_sizes.loc[transcript_names].to_numpy(),
+        'nmd_escape_size': get_nmd_escape_sizes(ranked_df.cds_size.to_numpy(), group_counts)
+    })
+
+    return add_pdot_columns(sizes)
+
+
 def get_upstream_frameshift(annotated_df, nmd_df):
     """
         This function will return whether a frameshift variant is PTVesc
@@ -206,9 +422,7 @@ def get_upstream_frameshift(annotated_df, nmd_df):
     :return:
     """
 
-    hgvsp_pattern = '^.*\.\d*:p\..{3}(\d*).{3}fsTer(\d*)'
-
-    annotated_df[['var_pdot', 'stop_pdot_shift']] = annotated_df.HGVSp.str.extract(hgvsp_pattern)
+    annotated_df[['var_pdot', 'stop_pdot_shift']] = extract_groups(annotated_df.HGVSp, _HGVSP_RE)
     annotated_df['stop_pdot_shift'] = annotated_df.stop_pdot_shift.replace("^$", np.nan, regex=True)
 
     # add a check for matching expected HGVSp pattern
@@ -220,9 +434,15 @@ def get_upstream_frameshift(annotated_df, nmd_df):
                 "Please refer to https://varnomen.hgvs.org/recommendations/protein/variant/frameshift/",
                       HGVSpPatternWarning)
 
-    annotated_df['stop_pdot'] = annotated_df.var_pdot.astype('Int64') + annotated_df.stop_pdot_shift.astype('Int64')
+    # extracted columns stay strings, only the sum is numeric. empty captures (e.g. fsTer?) become NaN
+    var_pdot = pd.to_numeric(annotated_df.var_pdot, errors='coerce')
+    annotated_df['stop_pdot'] = var_pdot + pd.to_numeric(annotated_df.stop_pdot_shift, errors='coerce')
     annotated_df = annotated_df.merge(nmd_df[['transcript_name', 'nmd_pdot_start']],
                                    on='transcript_name', how='left')
-    annotated_df['is_nmd_frameshift'] = annotated_df.stop_pdot > annotated_df.nmd_pdot_start
+
+    # compare as plain float arrays, missing positions are NaN and compare as False
+    stop_pdot = annotated_df.stop_pdot.to_numpy(dtype='float64', na_value=np.nan)
+    nmd_pdot_start = annotated_df.nmd_pdot_start.to_numpy(dtype='float64', na_value=np.nan)
+    annotated_df['is_nmd_frameshift'] = stop_pdot > nmd_pdot_start
 
     return annotated_df
@@ -1,5 +1,8 @@
 import unittest
+import unittest.mock
 import os
+import tempfile
+import annotating_nmd
 from annotating_nmd import *
 
 
@@ -29,6 +32,65 @@ class TestNMD(unittest.TestCase):
         # runs correctly, adds size and transcript_name columns
         out_bed = preprocess_bed(TestNMD.cds_bed.copy())
         self.assertEqual(list(out_bed.columns), out_columns)
+        self.assertIsInstance(out_bed.strand.dtype, pd.CategoricalDtype)
+
+        # strand values other than +/- are kept
+        unstranded_bed = TestNMD.cds_bed.copy()
+        unstranded_bed.loc[unstranded_bed.strand == '-', 'strand'] = '.'
+        out_bed = preprocess_bed(unstranded_bed.copy())
+        self.assertEqual(out_bed.strand.to_list(), unstranded_bed.strand.to_list())
+        self.assertEqual(make_boundaries_df(unstranded_bed.copy()).strand.to_list(), ['+', '+', '.', '.'])
+        self.assertEqual(get_nmd_escape_boundaries(out_bed[out_bed.strand == '.']).strand.to_list(), ['.', '.'])
+
+    def test_extract_groups(self):
+        cds_ids = pd.Series(['NM_003620.4_cds_0_0_chr17_58677776_f', 'NOT A CDS ID'], index=[3, 1])
+
+        # pyarrow kernel (if installed) and pandas str.extract fallback give the same result
+        for arrow_compute in [annotating_nmd.pc, None]:
+            with self.subTest(msg=f'pyarrow: {arrow_compute is not None}'), \
+                    unittest.mock.patch('annotating_nmd.pc', arrow_compute):
+                result = extract_groups(cds_ids, r'(?P<transcript_name>^.*\.\d*)_cds.*$')
+                self.assertEqual(list(result.index), [3, 1])
+                self.assertEqual(result.transcript_name[3], 'NM_003620.4')
+                self.assertTrue(pd.isna(result.transcript_name[1]))
+
+                # non-string values do not match
+                mixed_ids = pd.Series(['NM_003620.4_cds_0_0_chr17_58677776_f', 5, None], dtype=object)
+                result = extract_groups(mixed_ids, r'(?P<transcript_name>^.*\.\d*)_cds.*$')
+                self.assertEqual(result.transcript_name[0], 'NM_003620.4')
+                self.assertTrue(result.transcript_name[1:].isna().all())
+
+                # lookahead is not supported by RE2
+                result = extract_groups(cds_ids, r'(?P<transcript_name>^.*\.\d*)(?=_cds)')
+                self.assertEqual(result.transcript_name[3], 'NM_003620.4')
+                self.assertTrue(pd.isna(result.transcript_name[1]))
+                out_bed = preprocess_bed(TestNMD.cds_bed.copy(), capture_pattern=r'(?P<t>^.*\.\d*)(?=_cds)')
+                self.assertEqual(out_bed.transcript_name.unique().tolist(), ['NM_003620.4', 'NM_138576.4'])
+
+                # unicode digits match like python re
+                result = extract_groups(pd.Series(['NM_1.\u0663_cds_x']), r'(?P<transcript_name>^.*\.\d*)_cds.*$')
+                self.assertEqual(result.transcript_name[0], 'NM_1.\u0663')
+
+    def test_sort_transcript_bed(self):
+        plus_df = TestNMD.cds_bed[TestNMD.cds_bed.strand == '+'].copy()
+        sorted_df = sort_transcript_bed(plus_df)
+        self.assertEqual(len(sorted_df), 6)
+        self.assertTrue(sorted_df.start.is_monotonic_decreasing)
+
+        # only the last 2 CDS exons, in the same order as the full sort
+        last_df = sort_transcript_bed(plus_df, n_exons=2)
+        self.assertEqual(last_df.start.to_list(), sorted_df.start.to_list()[:2])
+
+        minus_df = TestNMD.cds_bed[TestNMD.cds_bed.strand == '-'].copy()
+        self.assertEqual(sort_transcript_bed(minus_df, n_exons=2).start.to_list(), [99640487, 99697681])
+
+    def test_rank_bed(self):
+        ranked_df = rank_bed(preprocess_bed(TestNMD.cds_bed.copy()))
+        self.assertEqual(ranked_df.cds_rank.to_list(), [0, 1, 2, 3, 4, 5, 0, 1, 2, 3])
+
+        # last CDS exon is the highest start on + strand and the lowest start on - strand
+        last_exons = ranked_df[ranked_df.cds_rank == 0]
+        self.assertEqual(last_exons.start.to_list(), [58740355, 99640487])
 
     def test_get_nmd_escape_size(self):
         test_df = preprocess_bed(TestNMD.cds_bed.copy())
@@ -71,6 +133,13 @@ class TestNMD(unittest.TestCase):
                 result = get_nmd_escape_size(test['data'].copy())
                 self.assertEqual(result, test['expected_size'])
 
+    def test_get_nmd_escape_sizes(self):
+        # transcripts with 3 exons (penultimate >55), 1 exon, and 2 exons (penultimate <55)
+        cds_sizes = np.array([100, 60, 3, 7, 9, 40])
+        group_counts = np.array([3, 1, 2])
+        result = get_nmd_escape_sizes(cds_sizes, group_counts)
+        self.assertEqual(result.tolist(), [100 + 55, 7, 9 + 40])
+
     def test_make_cds_size_df(self):
         sizes_df = make_cds_size_df(TestNMD.cds_bed.copy())
         expected_cds_sizes = [1818, 2685]
@@ -78,11 +147,34 @@ class TestNMD(unittest.TestCase):
         self.assertEqual(sizes_df.cds_size.to_list(), expected_cds_sizes)
         self.assertEqual(sizes_df.nmd_escape_size.to_list(), expected_nmd_sizes)
 
+    def test_make_cds_size_df_from_path(self):
+        expected_df = make_cds_size_df(TestNMD.cds_bed.copy())
+
+        # chunks of 3 and 4 lines split both transcripts across chunks
+        for chunksize in [1, 3, 4, 100]:
+            with self.subTest(msg=f'chunksize={chunksize}'):
+                sizes_df = make_cds_size_df_from_path(TestNMD.test_bed_file, chunksize=chunksize)
+                pd.testing.assert_frame_equal(sizes_df, expected_df)
+
+        # duplicate CDS in a later chunk only counts once
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dup_bed_file = os.path.join(tmp_dir, 'dup_cds.bed')
+            dup_bed = pd.concat([TestNMD.cds_bed, TestNMD.cds_bed.iloc[[0, -1]]])
+            dup_bed.to_csv(dup_bed_file, sep='\t', header=False, index=False)
+            for chunksize in [1, 5, 100]:
+                with self.subTest(msg=f'duplicates, chunksize={chunksize}'):
+                    sizes_df = make_cds_size_df_from_path(dup_bed_file, chunksize=chunksize)
+                    pd.testing.assert_frame_equal(sizes_df, expected_df)
+
     def test_get_nmd_escape_boundaries(self):
         # test on 1 transcript
         nmd_df = get_nmd_escape_boundaries(TestNMD.cds_bed[TestNMD.cds_bed.strand == '+'].copy())
         self.assertEqual(len(nmd_df), 2)
 
+        # input column dtypes are preserved
+        for col in ['start', 'end', 'cds_size']:
+            self.assertTrue(pd.api.types.is_integer_dtype(nmd_df[col]))
+
         # test on all transcripts
         cds_df = preprocess_bed(TestNMD.cds_bed.copy())
         nmd_df = cds_df.groupby('transcript_name').apply(get_nmd_escape_boundaries, include_groups=False)
@@ -91,6 +183,22 @@ class TestNMD(unittest.TestCase):
         # test convenience wrapper
         nmd_df = make_boundaries_df(TestNMD.cds_bed.copy())
         self.assertEqual(len(nmd_df), 4)
+        self.assertEqual(nmd_df.start.to_list(), [58740355, 58734147, 99640487, 99697681])
+        self.assertEqual(nmd_df.end.to_list(), [58740913, 58734202, 99642532, 99697736])
+        self.assertEqual(nmd_df.cds_size.to_list(), [558, 55, 2045, 55])
+
+        # same as grouping by transcript
+        grouped_df = cds_df.groupby('transcript_name').apply(get_nmd_escape_boundaries, include_groups=False)
+        pd.testing.assert_frame_equal(make_boundaries_df(cds_df.copy()), grouped_df, check_index_type=False)
+
+        # transcript_name without cds_size
+        nmd_df = make_boundaries_df(cds_df.drop(columns='cds_size'))
+        self.assertEqual(nmd_df.cds_size.to_list(), [558, 55, 2045, 55])
+
+        # missing bed columns
+        with self.assertRaises(Exception) as context:
+            make_boundaries_df(cds_df[['chrom', 'start', 'transcript_name', 'cds_size']].copy())
+        self.assertEqual(context.exception.args[0], "BED file is not in 6 column format")
 
     def test_get_upstream_frameshift(self):
 
@@ -139,6 +247,11 @@ class TestNMD(unittest.TestCase):
         self.assertTrue((result.expected_result == result.is_nmd_frameshift).all())
         self.assertEqual(len(result), 7)
 
+        # extracted pdot columns are kept as strings, only stop_pdot is numeric
+        self.assertEqual(result.var_pdot[0], '300')
+        self.assertEqual(result.stop_pdot_shift[0], '129')
+        self.assertEqual(result.stop_pdot[0], 429)
+
         # throw warnings
         with self.assertWarns(Warning) as context:
             get_upstream_frameshift(test_df.iloc[-3:].copy(), sizes_df)